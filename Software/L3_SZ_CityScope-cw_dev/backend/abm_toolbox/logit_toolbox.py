@@ -1,12 +1,26 @@
 import pandas as pd
 import time
+import copy
+import threading
 import numpy as np
+from scipy.special import softmax, log_softmax
+from scipy.optimize import minimize
 from sklearn.metrics import confusion_matrix, accuracy_score, f1_score
 import pylogit as pl
+from pylogit import estimation as pl_estimation
 from collections import OrderedDict
+from functools import lru_cache
+from contextlib import contextmanager
+from joblib import Parallel, delayed
+from threadpoolctl import threadpool_limits
+try:
+    from numba import njit, prange, get_num_threads, set_num_threads
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
 
 
-def long_form_data(mode_table, alt_attrs, generic_attrs, modes, y_true=True):
+def long_form_data(mode_table, alt_attrs, generic_attrs, modes, y_true=True, return_arrays=False):
     """
     generate long form data for logit model from mode table
 
@@ -17,33 +31,51 @@ def long_form_data(mode_table, alt_attrs, generic_attrs, modes, y_true=True):
                value=varname for each alternative in mode_table
     generic_attrs: case-specific attributes, generally demographic vars, list, ele=varname in mode_table.
     modes: a list of mode names
+    return_arrays: whether or not to also return the attributes as contiguous float32 arrays
 
     Returns:
     -----------------------------------
     long_data_df: pandas dataframe in logit long data form
+    data_arrays: only if return_arrays=True, a dict, "X_alt" (num_rows * num_alt_attrs) and
+                 "X_case" (num_rows * num_generic_attrs) arrays, "alt_attrs" and "generic_attrs" their column names
     """
-    nalt = len(modes)
-    basic_columns = ['group', 'alt', 'choice']
-    alt_tmp, choice_tmp = modes, [0 for i in range(nalt)]
-    keys = basic_columns + list(alt_attrs.keys()) + generic_attrs
-    long_data_obj = {key: [] for key in keys}
-    for rid, row in mode_table.iterrows():
-        long_data_obj['group'] += [rid for i in range(nalt)]
-        long_data_obj['alt'] += alt_tmp
-        mode_choice = choice_tmp.copy()
-        if y_true:
-            mode_choice[modes.index(row['mode'])] = 1
-        long_data_obj['choice'] += mode_choice
-        for alt_attr in alt_attrs:
-            long_data_obj[alt_attr] += [row.get(row_attr, 0) for row_attr in alt_attrs[alt_attr]]
-        for g_attr in generic_attrs:
-            long_data_obj[g_attr] += [row[g_attr] for i in range(nalt)]
-    long_data_df = pd.DataFrame.from_dict(long_data_obj)
+    nalt, N = len(modes), len(mode_table)
+    long_data_obj = dict()
+    # one row per (case, alt), cases keep the index of mode_table as group id
+    long_data_obj['group'] = np.repeat(mode_table.index.values, nalt)
+    # categories keep the order of modes, make_model turns alt into an object column for pylogit
+    long_data_obj['alt'] = pd.Categorical(np.tile(np.asarray(modes, dtype=object), N), categories=modes)
+    if y_true:
+        choice = np.asarray(modes)[None, :] == mode_table['mode'].to_numpy()[:, None]
+        if not choice.any(axis=1).all():
+            unknown_modes = sorted(set(mode_table['mode'].to_numpy()[~choice.any(axis=1)]), key=str)
+            raise ValueError('Unknown modes not in {}: {}'.format(modes, unknown_modes))
+        long_data_obj['choice'] = choice.astype(np.int8).ravel()
+    else:
+        long_data_obj['choice'] = np.zeros(N * nalt, dtype=np.int8)
+    if return_arrays:
+        # Fortran order, each variable is a contiguous column
+        X_alt = np.empty((N * nalt, len(alt_attrs)), dtype=np.float32, order='F')
+        X_case = np.empty((N * nalt, len(generic_attrs)), dtype=np.float32, order='F')
+    for k, alt_attr in enumerate(alt_attrs):
+        # missing columns for some alternatives are filled with 0
+        long_data_obj[alt_attr] = mode_table.reindex(columns=alt_attrs[alt_attr], fill_value=0).to_numpy().ravel()
+        if return_arrays:
+            X_alt[:, k] = long_data_obj[alt_attr]
+    for k, g_attr in enumerate(generic_attrs):
+        long_data_obj[g_attr] = np.repeat(mode_table[g_attr].to_numpy(), nalt)
+        if return_arrays:
+            X_case[:, k] = long_data_obj[g_attr]
+    long_data_df = pd.DataFrame(long_data_obj)
+    if return_arrays:
+        data_arrays = {'X_alt': X_alt, 'X_case': X_case,
+                       'alt_attrs': list(alt_attrs), 'generic_attrs': list(generic_attrs)}
+        return long_data_df, data_arrays
     return long_data_df
 
 
 def long_form_data_upsample(long_data_df_in, upsample_new={0: '+0', 1: '+0', 2: '+0', 3: '+0'},
-                            seed=None, disp=True):
+                            seed=None, disp=True, rng=None):
     """
     make the long_form_data more balanced by upsampling
     (add randomly sampled new cases less represented alternatives)
@@ -55,36 +87,42 @@ def long_form_data_upsample(long_data_df_in, upsample_new={0: '+0', 1: '+0', 2:
                   key: index of alternaive
                   value: "+N" to add N cases or "*N" to increase the number of cases by N times.
     seed: random seed
+    rng: numpy random Generator, overrides seed if given
 
     Returns:
     -----------------------------------
     long_data_df_out: output long form dataframe after upsampling
     """
     print('upsampling...')
-    long_data_df_out = long_data_df_in.copy()
-    casedata_list = [data for caseID, data in long_data_df_out.copy().groupby('group')]
-    caseIDs = list(set(long_data_df_out['group']))
-    # alt_spec_casedata_list = dict()
+    long_data_df = long_data_df_in
+    if not long_data_df['group'].is_monotonic_increasing:
+        long_data_df = long_data_df.sort_values(by='group', kind='stable')
+    group_ids = long_data_df['group'].drop_duplicates().to_numpy()
+    nalt = int(len(long_data_df) / len(group_ids))
+    # one row per case, one column per alternative
+    choice_mat = long_data_df['choice'].to_numpy().reshape(-1, nalt)
     dist_before, dist_after = [], []
-    new_casedata_list = []
-    if seed is not None:
-        np.random.seed(seed)
+    sampled_cases_list = []
+    rng = np.random.default_rng(seed) if rng is None else rng
     for alt_idx in upsample_new:
-        this_alt_casedata_list = [data for data in casedata_list if list(data['choice'])[alt_idx] == 1]
-        num_this_alt_casedata = len(this_alt_casedata_list)
+        # positions (in group_ids) of the cases choosing this alternative
+        this_alt_cases = np.flatnonzero(choice_mat[:, alt_idx] == 1)
+        num_this_alt_casedata = len(this_alt_cases)
         dist_before.append('{}-{}'.format(alt_idx, num_this_alt_casedata))
         if upsample_new[alt_idx].startswith('+'):
             num_new = int(upsample_new[alt_idx][1:])
         elif upsample_new[alt_idx].startswith('*'):
             num_new = int(num_this_alt_casedata * (float(upsample_new[alt_idx][1:]) - 1))
-        # alt_spec_casedata_list[alt_idx] = this_alt_casedata_list
-        new_casedata_list += [this_alt_casedata_list[i].copy() for i in np.random.choice(
-            range(len(this_alt_casedata_list)), size=num_new)]
+        sampled_cases_list.append(rng.choice(this_alt_cases, size=num_new))
         dist_after.append('{}-{}'.format(alt_idx, num_this_alt_casedata + num_new))
-    maxID = np.array(caseIDs).max()
-    for idx, new_casedata in enumerate(new_casedata_list):
-        new_casedata['group'] = maxID + idx + 1
-    long_data_df_out = pd.concat([long_data_df_out] + new_casedata_list, axis=0)
+    # the empty array keeps upsample_new={} valid, nothing is added then
+    sampled_cases = np.concatenate([np.empty(0, dtype=np.intp)] + sampled_cases_list)
+    # rows of case i are at positions i*nalt ... i*nalt+nalt-1, gather all sampled rows at once
+    sampled_rows = (sampled_cases[:, None] * nalt + np.arange(nalt)).ravel()
+    maxID = group_ids.max()
+    new_casedata = long_data_df.iloc[sampled_rows].assign(
+        group=np.repeat(maxID + 1 + np.arange(len(sampled_cases)), nalt))
+    long_data_df_out = pd.concat([long_data_df_in, new_casedata], axis=0)
     if disp:
         print('Before: {}'.format(', '.join(dist_before)))
         print('After: {}'.format(', '.join(dist_after)))
@@ -92,23 +130,19 @@ def long_form_data_upsample(long_data_df_in, upsample_new={0: '+0', 1: '+0', 2:
     return long_data_df_out
 
 
-def logit_spec(long_data_df, alt_attr_vars, generic_attrs=[], constant=True,
+def build_spec(alt_attr_vars, generic_attrs=[], constant=True,
                alts={0: 'drive', 1: 'cycle', 2: 'walk', 3: 'PT'}, ref_alt_idx=0):
     """
-    generate specification & varnames for pylogit
+    generate specification & varnames for pylogit, independent of data
 
     Arguments:
     ------------------------------
-    long_data_df: pandas dataframe, long data, generated by long_form_data
-    alt_attr_vars: list of alternative specific vars
-    generic_attrs: list of case specific vars, generally demographic vars
-    constant: whether or not to include ASCs
-    alts: a dict or list to define indices and names of alternative
-    ref_alt_idx: index of reference alternative for ASC specification
+    see logit_spec
 
     Returns:
     --------------------------------
-    model: pylogit MNL model object
+    specifications: OrderedDict, pylogit specification
+    names: OrderedDict, pylogit varnames
     numCoef: the number of coefficients to estimated
     """
     specifications = OrderedDict()
@@ -128,7 +162,20 @@ def logit_spec(long_data_df, alt_attr_vars, generic_attrs=[], constant=True,
         # specifications['intercept'] = [i for i in range(nalt) if i != ref_alt_idx]
         specifications['intercept'] = [alts[i] for i in range(nalt) if i != ref_alt_idx]
         names['intercept'] = ['ASC for ' + alts[i] for i in range(nalt) if i != ref_alt_idx]
-    model = pl.create_choice_model(data=long_data_df.copy(),
+    numCoef = sum([len(specifications[s]) for s in specifications])
+    return specifications, names, numCoef
+
+
+def make_model(long_data_df, specifications, names, copy_data=True):
+    """
+    create pylogit MNL model object from long data and specification generated by build_spec
+    pylogit keeps a reference to the data and adds an "intercept" column to it,
+    so long_data_df is copied unless copy_data=False (only for frames owned by the caller of make_model)
+    pylogit needs an ndarray of alt ids, a categorical alt column is converted to object in the model data
+    """
+    model_data = long_data_df.copy() if copy_data else long_data_df
+    model_data['alt'] = np.asarray(model_data['alt'], dtype=object)
+    model = pl.create_choice_model(data=model_data,
                                    alt_id_col="alt",
                                    obs_id_col="group",
                                    choice_col="choice",
@@ -136,11 +183,143 @@ def logit_spec(long_data_df, alt_attr_vars, generic_attrs=[], constant=True,
                                    model_type="MNL",
                                    names=names
                                    )
-    numCoef = sum([len(specifications[s]) for s in specifications])
+    return model
+
+
+def logit_spec(long_data_df, alt_attr_vars, generic_attrs=[], constant=True,
+               alts={0: 'drive', 1: 'cycle', 2: 'walk', 3: 'PT'}, ref_alt_idx=0):
+    """
+    generate specification & varnames for pylogit
+
+    Arguments:
+    ------------------------------
+    long_data_df: pandas dataframe, long data, generated by long_form_data
+    alt_attr_vars: list of alternative specific vars
+    generic_attrs: list of case specific vars, generally demographic vars
+    constant: whether or not to include ASCs
+    alts: a dict or list to define indices and names of alternative
+    ref_alt_idx: index of reference alternative for ASC specification
+
+    Returns:
+    --------------------------------
+    model: pylogit MNL model object
+    numCoef: the number of coefficients to estimated
+    """
+    specifications, names, numCoef = build_spec(alt_attr_vars, generic_attrs, constant=constant,
+                                                alts=alts, ref_alt_idx=ref_alt_idx)
+    model = make_model(long_data_df, specifications, names)
     return model, numCoef
 
 
-def logit_est_disp(model, numCoef, nalt=4, disp=True):
+def logit_fit_fast(X, y, nalt, x0=None):
+    """
+    maximum likelihood estimation of a MNL model with analytic gradient and Hessian (scipy trust-ncg),
+    a thin alternative to pylogit's optimizer
+
+    Arguments:
+    ---------------------------
+    X: design matrix (num_cases * num_alts, num_coef), rows ordered by case then alternative
+    y: one-hot choices (num_cases * num_alts, )
+    nalt: the number of alternatives
+    x0: initial parameters, zeros by default
+
+    Return:
+    ----------------------------
+    scipy OptimizeResult, "x" is the estimated parameters, "fun" the negative log-likelihood
+    """
+    X = np.asarray(X, dtype=float)
+    ncs, numCoef = X.shape[0] // nalt, X.shape[1]
+    X3 = X.reshape(ncs, nalt, numCoef)
+    Y = np.asarray(y, dtype=float).reshape(ncs, nalt)
+    if x0 is None:
+        x0 = np.zeros(numCoef)
+
+    def neg_loglik(beta):
+        return -(Y * log_softmax((X @ beta).reshape(ncs, nalt), axis=1)).sum()
+
+    def grad(beta):
+        P = softmax((X @ beta).reshape(ncs, nalt), axis=1)
+        return X.T @ (P - Y).ravel()
+
+    def hess(beta):
+        # sum over cases of X_i' (diag(P_i) - P_i P_i') X_i, as two BLAS-3 products
+        P = softmax((X @ beta).reshape(ncs, nalt), axis=1)
+        XP = np.einsum('nj,njk->nk', P, X3)
+        return (X * P.reshape(-1, 1)).T @ X - XP.T @ XP
+
+    return minimize(neg_loglik, x0, jac=grad, hess=hess, method='trust-ncg')
+
+
+def _point_estimate(model, model_result, nalt, disp):
+    """
+    wrap and display a point-only estimation result ("x" and "fun"), see logit_est_disp
+    """
+    ncs = int(model.data.shape[0] / nalt)
+    beta = model_result['x']
+    if disp:
+        ll0 = np.log(1 / nalt) * ncs
+        ll = -model_result['fun']
+        mcr = 1 - ll / ll0
+        print('\n\nLogit model summary\n---------------------------')
+        print('number of cases: ', ncs)
+        print('Initial Log-likelihood: ', ll0)
+        print('Final Log-likelihood: ', ll)
+        print('McFadden R2: {:4.4}\n'.format(mcr))
+        print('\nLogit model parameters:\n---------------------------')
+        for varname, para in zip(model.ind_var_names, beta):
+            print('{}: {:4.6f}'.format(varname, para))
+    params = {varname: param for varname, param in zip(model.ind_var_names, beta)}
+    return {'just_point': True, 'params': params, 'model': model}
+
+
+@contextmanager
+def _numba_threads(limit):
+    """
+    limit the numba threads used by _logit_predict, threadpool_limits only covers BLAS / OpenMP
+    """
+    if not NUMBA_AVAILABLE or limit is None:
+        yield
+        return
+    old_limit = get_num_threads()
+    set_num_threads(max(1, min(limit, old_limit)))
+    try:
+        yield
+    finally:
+        set_num_threads(old_limit)
+
+
+# pylogit.estimation.minimize is patched process-wide by _record_iterates, one fit at a time
+_record_iterates_lock = threading.Lock()
+
+
+@contextmanager
+def _record_iterates(last_iterate):
+    """
+    record each optimizer iterate of fit_mle into last_iterate['x']
+    (pylogit passes no callback to scipy.optimize.minimize, so the minimize it calls is wrapped meanwhile)
+    the wrapper is module-wide, so fits run inside this context from several threads are serialized
+    """
+    with _record_iterates_lock:
+        minimize_orig = pl_estimation.minimize
+
+        def minimize_recording(*args, **kwargs):
+            callback_orig = kwargs.get('callback')
+
+            def callback(xk, *cb_args):
+                last_iterate['x'] = np.array(xk)
+                if callback_orig is not None:
+                    return callback_orig(xk, *cb_args)
+            kwargs['callback'] = callback
+            return minimize_orig(*args, **kwargs)
+
+        pl_estimation.minimize = minimize_recording
+        try:
+            yield
+        finally:
+            pl_estimation.minimize = minimize_orig
+
+
+def logit_est_disp(model, numCoef, nalt=4, disp=True, fast=False):
     """
     estimate a logit model and display results, using just_point=True in case of memory error
 
@@ -148,6 +327,7 @@ def logit_est_disp(model, numCoef, nalt=4, disp=True):
     ---------------------------
     model & numCoef: see logit_spec; nalt: the number of alternatives
     disp: whether or not to display estimation results.
+    fast: if True, estimate point values only with logit_fit_fast instead of pylogit's optimizer
 
     Return:
     ----------------------------
@@ -155,38 +335,80 @@ def logit_est_disp(model, numCoef, nalt=4, disp=True):
                        "model" is the pylogit MNL model object, it is better used when just_point=False
                        "params": a dict with key=varible_name and value=parameter, only valid for just_point=True
     """
+    if fast:
+        model_result = logit_fit_fast(model.design, model.choices, nalt, np.zeros(numCoef))
+        if not model_result['success']:
+            print('Warning: logit_fit_fast did not converge: {}'.format(model_result['message']))
+        return _point_estimate(model, model_result, nalt, disp)
+    last_iterate = {}
     try:
-        model.fit_mle(np.zeros(numCoef))
+        with _record_iterates(last_iterate):
+            model.fit_mle(np.zeros(numCoef))
         if disp:
             print(model.get_statsmodels_summary())
         params = {}
         for param, varname in zip(model.coefs.values, model.coefs.index):
             params[varname] = param
         return {'just_point': False, 'params': params, 'model': model}
-    except:
-        model_result = model.fit_mle(np.zeros(numCoef), just_point=True)
-        ncs = int(model.data.shape[0] / nalt)
-        beta = model_result['x']
-        if disp:
-            ll0 = np.log(1 / nalt) * ncs
-            ll = -model_result['fun']
-            mcr = 1 - ll / ll0
-            print('\n\nLogit model summary\n---------------------------')
-            print('number of cases: ', ncs)
-            print('Initial Log-likelihood: ', ll0)
-            print('Final Log-likelihood: ', ll)
-            print('McFadden R2: {:4.4}\n'.format(mcr))
-            print('\nLogit model parameters:\n---------------------------')
-            for varname, para in zip(model.ind_var_names, beta):
-                print('{}: {:4.6f}'.format(varname, para))
-        params = {varname: param for varname, param in zip(model.ind_var_names, beta)}
-        return {'just_point': True, 'params': params, 'model': model}
+    except (MemoryError, np.linalg.LinAlgError):
+        # warm start from the last iterate of the failed run
+        x0 = last_iterate.get('x', np.zeros(numCoef))
+        model_result = model.fit_mle(x0, just_point=True)
+        return _point_estimate(model, model_result, nalt, disp)
+
+
+def _subset_model(model, long_data_df, rows):
+    """
+    shallow copy of a pylogit model for long_data_df, whose rows are the given rows of model.data
+    (reuses the design matrix of model instead of rebuilding and re-validating it)
+    """
+    sub_model = copy.copy(model)
+    sub_model.data = long_data_df
+    sub_model.design = model.design[rows]
+    sub_model.alt_IDs = np.asarray(long_data_df[model.alt_id_col], dtype=object)
+    sub_model.choices = long_data_df[model.choice_col].values
+    return sub_model
+
+
+def _run_fold(holdout_idx, full_model, fold_of_row, numCoef, alts, upsample_new, method, rng, blas_threads=1,
+              fast=True):
+    """
+    estimate on all folds but holdout_idx and evaluate on holdout_idx, see logit_cv
+    full_model is the pylogit model of all data (with a unique index), fold_of_row gives the fold of each row,
+    fold data is only materialized here
+    BLAS and numba are limited to blas_threads threads so that parallel folds do not oversubscribe the cores
+    fast: estimate with logit_fit_fast (point estimates are all cv needs), see logit_est_disp
+
+    Return:
+    ----------------------------
+    accuracy, F1 macro score and confusion matrix of the holdout fold
+    """
+    with threadpool_limits(limits=blas_threads, user_api='blas'), _numba_threads(blas_threads):
+        print('\ncv for fold=', holdout_idx)
+        long_data_df = full_model.data
+        long_data_df_test = long_data_df.iloc[np.flatnonzero(fold_of_row == holdout_idx)]
+        # sort training rows by case, then by alternative in the order of alts (the indices upsample_new uses)
+        train_rows = np.flatnonzero(fold_of_row != holdout_idx)
+        alt_codes = pd.Categorical(long_data_df['alt'], categories=[alts[i] for i in range(len(alts))]).codes
+        train_rows = train_rows[np.lexsort((alt_codes[train_rows], long_data_df['group'].to_numpy()[train_rows]))]
+        long_data_df_train = long_data_df.iloc[train_rows]
+        long_data_df_train = long_form_data_upsample(long_data_df_train, upsample_new=upsample_new, rng=rng)
+        # upsampled rows keep the index of the rows they are copied from
+        model_train = _subset_model(full_model, long_data_df_train,
+                                    long_data_df.index.get_indexer(long_data_df_train.index))
+        modelDict_train = logit_est_disp(model_train, numCoef, nalt=len(alts), disp=False, fast=fast)
+        pred_prob_test, y_pred_test, v_test = asclogit_pred(long_data_df_test, modelDict_train,
+                                                            customIDColumnName='group', alts=alts, method=method,
+                                                            rng=rng)
+        y_true_test = np.array(long_data_df_test['choice']).reshape(-1, len(alts)).argmax(axis=1)
+        ac, f1 = accuracy_score(y_true_test, y_pred_test), f1_score(y_true_test, y_pred_test, average='macro')
+        return ac, f1, confusion_matrix(y_true_test, y_pred_test)
 
 
 def logit_cv(data, alt_attr_vars, generic_attrs, constant=True, nfold=5, seed=None,
              alts={0: 'drive', 1: 'cycle', 2: 'walk', 3: 'PT'},
              upsample_new={0: '+0', 1: '+0', 2: '+0', 3: '+0'},
-             method='max'
+             method='max', n_jobs=-1, rng=None, blas_threads_per_worker=1, fast=True
              ):
     """
     cross validation for logit model performance
@@ -195,52 +417,89 @@ def logit_cv(data, alt_attr_vars, generic_attrs, constant=True, nfold=5, seed=No
     ---------------------------
     data: input long form pandas dataframe
     alt_attr_vars, generic_attrs, constant, alts: logit model specification, see logit_spec
-    nfold: number of folds in cv; seed: random seed for np.random
+    nfold: number of folds in cv; seed: random seed
+    rng: numpy random Generator, overrides seed if given, each fold gets an independent child Generator
     upsample_new: upsampling specification for unbalanced data, see long_form_data_upsample
-    method:
+    method: how to predict the chosen alternative, see asclogit_pred
+    n_jobs: number of folds run in parallel by joblib, -1 to use all cores
+    blas_threads_per_worker: max number of BLAS and numba threads in each fold, None for no limit
+    fast: if True, estimate each fold with logit_fit_fast instead of pylogit's optimizer, see logit_est_disp
 
     Return:
     ----------------------------
     cv_metrics: a dict with average accuracy and F1 macro score
     cv_metrics_detail: a dict with accuracy and F1 macro score  for each fold
     """
-    long_data_df = data.copy()
-    if seed is not None:
-        np.random.seed(seed)
-    caseIDs = list(set(long_data_df['group']))
-    np.random.shuffle(caseIDs)
+    long_data_df = data if data.index.is_unique else data.reset_index(drop=True)
+    rng = np.random.default_rng(seed) if rng is None else rng
+    # assign shuffled cases to folds in turn, rows follow the fold of their case
+    case_codes, caseIDs = pd.factorize(long_data_df['group'])
     ncs = len(caseIDs)
-    nsampe_fold = int(ncs / nfold)
-    cv_data = {i: long_data_df.loc[long_data_df['group'].isin(
-        caseIDs[i * nsampe_fold: (i + 1) * nsampe_fold])].copy() for i in range(nfold)}
+    fold_of_case = np.empty(ncs, dtype=int)
+    fold_of_case[rng.permutation(ncs)] = np.arange(ncs) % nfold
+    fold_of_row = fold_of_case[case_codes]
     cv_metrics_detail = {i: {'accuracy': None, 'f1_macro': None} for i in range(nfold)}
     accuracy_list, f1_macro_list = [], []
-    for holdout_idx in cv_data:
-        print('\ncv for fold=', holdout_idx)
-        long_data_df_test = cv_data[holdout_idx].copy()
-        train_list = [d.copy() for idx, d in cv_data.items() if idx != holdout_idx]
-        long_data_df_train = pd.concat(train_list, axis=0).sort_values(by=['group', 'alt'])
-        long_data_df_train = long_form_data_upsample(long_data_df_train, upsample_new=upsample_new, seed=seed)
-        model_train, numCoefs = logit_spec(long_data_df_train, alt_attr_vars, generic_attrs, constant=constant,
-                                           alts=alts)
-        modelDict_train = logit_est_disp(model_train, numCoefs, nalt=len(alts), disp=False)
-        pred_prob_test, y_pred_test = asclogit_pred(long_data_df_test, modelDict_train,
-                                                    customIDColumnName='group', alts=alts, method=method, seed=seed)
-        y_true_test = np.array(long_data_df_test['choice']).reshape(-1, len(alts)).argmax(axis=1)
-        ac, f1 = accuracy_score(y_true_test, y_pred_test), f1_score(y_true_test, y_pred_test, average='macro')
+    # specification does not depend on data, build it and the design matrix once for all folds
+    specifications, names, numCoef = build_spec(alt_attr_vars, generic_attrs, constant=constant, alts=alts)
+    # pylogit adds an intercept column to the model data, never let it be the caller's data
+    full_model = make_model(long_data_df, specifications, names, copy_data=long_data_df is data)
+    # folds are independent from each other, run them in parallel
+    fold_rngs = rng.spawn(nfold)
+    fold_results = Parallel(n_jobs=n_jobs, backend='loky')(
+        delayed(_run_fold)(holdout_idx, full_model, fold_of_row, numCoef, alts, upsample_new, method,
+                           fold_rngs[holdout_idx], blas_threads_per_worker, fast)
+        for holdout_idx in range(nfold))
+    for holdout_idx, (ac, f1, cm) in enumerate(fold_results):
         cv_metrics_detail[holdout_idx]['accuracy'] = ac
         accuracy_list.append(ac)
         cv_metrics_detail[holdout_idx]['f1_macro'] = f1
         f1_macro_list.append(f1)
-        print(confusion_matrix(y_true_test, y_pred_test))
+        print('\nconfusion matrix for fold=', holdout_idx)
+        print(cm)
     cv_metrics = {'accuracy': np.asarray(accuracy_list).mean(),
                   'f1_macro': np.asarray(f1_macro_list).mean()}
     print('cv finished\n')
     return cv_metrics, cv_metrics_detail
 
 
+_PARAM_ALT_SPECIFIC, _PARAM_ASC, _PARAM_CASE_SPECIFIC = 0, 1, 2
+
+
+@lru_cache(maxsize=32)
+def _classify_params(varnames, alt_names):
+    """
+    classify parameter names of a logit model, see logit_spec for the naming
+
+    Arguments:
+    -------------------------------
+    varnames: tuple of parameter names
+    alt_names: tuple of alternative names
+
+    Return:
+    ----------------------------------
+    kinds: tuple, _PARAM_ALT_SPECIFIC, _PARAM_ASC or _PARAM_CASE_SPECIFIC (case specific var interacted with an alt)
+    alt_of: tuple, the alternative name a parameter is for, None for alternative specific vars
+    main_of: tuple, the variable name without the alternative suffix
+    """
+    kinds, alt_of, main_of = [], [], []
+    for varname in varnames:
+        interact_with_alt = next((alt_name for alt_name in alt_names if varname.endswith(' for ' + alt_name)), None)
+        if interact_with_alt is None:
+            # this is an alternative specific varname
+            kinds.append(_PARAM_ALT_SPECIFIC)
+            main_of.append(varname)
+        else:
+            # this is a case specific varname (ASC-like)
+            main_varname = varname[:-len(' for ' + interact_with_alt)]
+            kinds.append(_PARAM_ASC if main_varname == 'ASC' else _PARAM_CASE_SPECIFIC)
+            main_of.append(main_varname)
+        alt_of.append(interact_with_alt)
+    return tuple(kinds), tuple(alt_of), tuple(main_of)
+
+
 def asclogit_pred(data_in, modelDict, customIDColumnName, method='random', seed=None,
-                  alts={0: 'drive', 1: 'cycle', 2: 'walk', 3: 'PT'}):
+                  alts={0: 'drive', 1: 'cycle', 2: 'walk', 3: 'PT'}, rng=None, data_arrays=None):
     """
     predict probabilities for logit model
 
@@ -250,12 +509,16 @@ def asclogit_pred(data_in, modelDict, customIDColumnName, method='random', seed=
     modelDict: see logit_est_disp
     customIDColumnName: the column name of customer(case) ID
     alts: a dict or list defining the indices and name of altneratives
+    method: 'max' to choose the most probable alternative, 'random' to sample by probabilities, 'none' for no choice
+    seed: random seed for method='random'; rng: numpy random Generator, overrides seed if given
+    data_arrays: arrays of the same rows as data_in, see long_form_data(return_arrays=True),
+                 if given, variables are read from these arrays instead of data_in columns
 
     Return:
     ----------------------------------
     a mat (num_cases * num_alts) of predicted probabilities, row sum=1
     """
-    data = data_in.copy()
+    data = data_in  # read only, utilities are kept in local arrays
     numChoices = len(set(data[customIDColumnName]))
     # fectch variable names and parameters
     params, varnames = modelDict['params'].values(), modelDict['params'].keys()
@@ -264,48 +527,109 @@ def asclogit_pred(data_in, modelDict, customIDColumnName, method='random', seed=
     nalt = len(alts)
     if isinstance(alts, list):
         alts = {i: alts[i] for i in range(nalt)}
-    dummies_dict = dict()
-    case_varname_endswith_flag = []
-    for alt_idx, alt_name in alts.items():
-        case_varname_endswith_flag.append(' for ' + alt_name)
-        tmp = [0 for i in range(nalt)]
-        tmp[alt_idx] = 1
-        dummies_dict[alt_name] = np.tile(np.asarray(tmp), numChoices)
-    case_varname_endswith_flag = tuple(case_varname_endswith_flag)
-
-    # calc utilities
-    data['utility'] = 0
-    for varname, param in zip(varnames, params):
-        if not varname.endswith(case_varname_endswith_flag):
-            # this is an alternative specific varname
-            data['utility'] += data[varname] * param
+    # rows are ordered by case then alternative, column k of the tiled identity is the dummy of alt k
+    alt_dummies = np.tile(np.eye(nalt, dtype=np.int8), (numChoices, 1))
+    dummies_dict = {alt_name: alt_dummies[:, alt_idx] for alt_idx, alt_name in alts.items()}
+
+    if data_arrays is not None:
+        for key in ['X_alt', 'X_case']:
+            if len(data_arrays[key]) != len(data):
+                raise ValueError('data_arrays["{}"] has {} rows, data_in has {}'.format(
+                    key, len(data_arrays[key]), len(data)))
+        columns = {var: data_arrays['X_alt'][:, k] for k, var in enumerate(data_arrays['alt_attrs'])}
+        columns.update({var: data_arrays['X_case'][:, k] for k, var in enumerate(data_arrays['generic_attrs'])})
+    else:
+        columns = data
+
+    # calc utilities: design matrix (one column per parameter) times parameter vector
+    kinds, alt_of, main_of = _classify_params(tuple(varnames), tuple(alts.values()))
+    X = np.empty((len(data), len(varnames)))
+    for k in range(len(kinds)):
+        if kinds[k] == _PARAM_ALT_SPECIFIC:
+            X[:, k] = columns[main_of[k]]
+        elif kinds[k] == _PARAM_ASC:
+            X[:, k] = dummies_dict[alt_of[k]]
+        elif main_of[k] in columns:
+            X[:, k] = columns[main_of[k]] * dummies_dict[alt_of[k]]
         else:
-            # this is a case specific varname (ASC-like)
-            main_varname, interact_with_alt = varname.split(' for ')
-            use_dummy = dummies_dict[interact_with_alt]
-            if main_varname == 'ASC':
-                data['utility'] += use_dummy * param
-            elif main_varname in data.columns:
-                data['utility'] += data[main_varname] * use_dummy * param
-            else:
-                print('Error: can not find variable: {}'.format(varname))
-                return
+            print('Error: can not find variable: {} for {}'.format(main_of[k], alt_of[k]))
+            return
+    beta = np.asarray(list(params), dtype=float)
+    if method == 'random':
+        rng = np.random.default_rng(seed) if rng is None else rng
+        rand = rng.random(numChoices)
+    else:
+        rand = np.empty(0)
 
     # calc probabilities given utilities
-    v = np.array(data['utility']).copy().reshape(numChoices, -1)
-    v_raw = v.copy()
-    v = v - v.mean(axis=1, keepdims=True)
-    v[v > 700] = 700
-    v[v < -700] = -700
-    expV = np.exp(v)
-    p = expV / expV.sum(axis=1, keepdims=True)
-    p = p.reshape(-1, nalt)
-    if method == 'max':
-        y = p.argmax(axis=1)
-    elif method == 'random':
-        if seed is not None:
-            np.random.seed(seed)
-        y = np.asarray([np.random.choice(list(alts.keys()), size=1, p=row)[0] for row in p])
-    elif method == 'none':
+    if NUMBA_AVAILABLE:
+        p, y, v_raw = _logit_predict(X, beta, nalt, method == 'random', rand)
+    else:
+        # softmax does not modify its input, so the utilities are returned without a copy
+        v_raw = (X @ beta).reshape(numChoices, nalt)
+        p = softmax(v_raw, axis=1)
+        if method == 'random':
+            # inverse-CDF sampling, one uniform draw per case
+            cum_p = p.cumsum(axis=1)
+            cum_p[:, -1] = 1
+            y = (rand[:, None] < cum_p).argmax(axis=1)
+        else:
+            y = p.argmax(axis=1)
+    if method == 'none':
         y = None
-    return p, y, v_raw
\ No newline at end of file
+    return p, y, v_raw
+
+
+if NUMBA_AVAILABLE:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _logit_predict(X, beta, nalt, do_sample, rand):
+        """
+        fused utility / softmax / choice kernel for asclogit_pred, one pass per case
+
+        Arguments:
+        -------------------------------
+        X: design matrix (num_cases * num_alts, num_params), rows ordered by case then alternative
+        beta: parameter vector (num_params, )
+        nalt: the number of alternatives
+        do_sample: if True, choose by inverse-CDF sampling with rand, otherwise choose the max probability
+        rand: uniform random numbers (num_cases, ), only used when do_sample=True
+
+        Return:
+        ----------------------------------
+        p: predicted probabilities (num_cases, num_alts); y: chosen alternative indices; v: utilities
+        """
+        n = X.shape[0] // nalt
+        p = np.empty((n, nalt))
+        v = np.empty((n, nalt))
+        y = np.empty(n, np.int64)
+        for i in prange(n):
+            for j in range(nalt):
+                vij = 0.0
+                for k in range(X.shape[1]):
+                    vij += X[i * nalt + j, k] * beta[k]
+                v[i, j] = vij
+            # seed with a real utility, fastmath assumes no infinities
+            v_max = v[i, 0]
+            for j in range(1, nalt):
+                if v[i, j] > v_max:
+                    v_max = v[i, j]
+            p_sum = 0.0
+            for j in range(nalt):
+                p[i, j] = np.exp(v[i, j] - v_max)
+                p_sum += p[i, j]
+            for j in range(nalt):
+                p[i, j] /= p_sum
+            y[i] = 0
+            if do_sample:
+                y[i] = nalt - 1
+                cum_p = 0.0
+                for j in range(nalt):
+                    cum_p += p[i, j]
+                    if rand[i] < cum_p:
+                        y[i] = j
+                        break
+            else:
+                for j in range(1, nalt):
+                    if p[i, j] > p[i, y[i]]:
+                        y[i] = j
+        return p, y, v